@@ -1,27 +1,141 @@
 import argparse
 import csv
+import os
+import re
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from functools import lru_cache
+from http.cookiejar import DefaultCookiePolicy
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
+import msgspec
 import requests
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
 
 
 API_VACANCIES = "https://api.hh.ru/vacancies"
 
-
-def format_salary(s: Optional[Dict[str, Any]]) -> str:
+_WS_RE = re.compile(r"\s+")
+
+# Потолок параллельных запросов деталей = размер пула соединений,
+# чтобы воркеры не ждали свободного keep-alive соединения.
+MAX_WORKERS = 32
+
+# Статусы, на которые адаптер SESSION делает ретраи: для лимитера это перегрузка
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+
+# Одна сессия на весь запуск: keep-alive и пул соединений urllib3,
+# чтобы не делать TCP+TLS handshake на каждую страницу/вакансию.
+# Ответы кэшируются на диске: детали вакансий живут сутки, поиск — 5 минут,
+# ETag/Last-Modified от hh.ru тоже учитываются. С пакетом brotli urllib3 сам
+# добавляет "br" в Accept-Encoding — JSON деталей приходит заметно компактнее.
+SESSION = CachedSession(
+    "hh_cache.sqlite",
+    backend="sqlite",
+    expire_after=3600,
+    urls_expire_after={
+        "api.hh.ru/vacancies/*": 86400,
+        "api.hh.ru/vacancies": 300,
+    },
+    cache_control=True,
+)
+SESSION.headers.update({"User-Agent": "hh-vacancy-parser (learning project)"})
+# Сессию делят потоки воркеров. API не нужны куки, поэтому не сохраняем их
+# вовсе: общее состояние сессии между запросами не меняется.
+SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MAX_WORKERS,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=OVERLOAD_STATUSES,
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
+
+# Схемы ответов hh.ru: только нужные нам поля, остальное msgspec пропускает
+# при разборе, а доступ к полям — обычные атрибуты вместо цепочек .get().
+# Строки из API объявлены Optional: null в одном поле не должен ронять
+# разбор всей страницы, в CSV он превращается в "".
+class Named(msgspec.Struct):
+    """Вложенный объект вида {"id": ..., "name": ...} (employer, area, schedule...)."""
+
+    name: Optional[str] = None
+
+
+class Salary(msgspec.Struct):
+    from_: Union[int, float, None] = msgspec.field(default=None, name="from")
+    to: Union[int, float, None] = None
+    currency: Optional[str] = None
+    gross: Optional[bool] = None
+
+
+class Vacancy(msgspec.Struct):
+    """Вакансия из поиска; *_name / key_skills / description_snippet — из деталей."""
+
+    id: Optional[str] = None
+    name: Optional[str] = None
+    employer: Optional[Named] = None
+    salary: Optional[Salary] = None
+    area: Optional[Named] = None
+    published_at: Optional[str] = None
+    alternate_url: Optional[str] = None
+    url: Optional[str] = None
+
+    experience_name: str = ""
+    schedule_name: str = ""
+    employment_name: str = ""
+    key_skills: str = ""
+    description_snippet: str = ""
+
+
+class SearchPage(msgspec.Struct):
+    items: List[Vacancy] = []
+    pages: Optional[int] = None
+
+
+class VacancyDetails(msgspec.Struct):
+    experience: Optional[Named] = None
+    schedule: Optional[Named] = None
+    employment: Optional[Named] = None
+    key_skills: Optional[List[Named]] = None
+    description: Optional[str] = None
+
+
+_SEARCH_DECODER = msgspec.json.Decoder(SearchPage)
+_DETAILS_DECODER = msgspec.json.Decoder(VacancyDetails)
+
+
+def _name(obj: Optional[Named]) -> str:
+    """name вложенного объекта или "" (нет объекта / name: null)."""
+    return (obj.name or "") if obj else ""
+
+
+def format_salary(s: Optional[Salary]) -> str:
     """Красивое форматирование зарплаты из поля salary."""
-    if not s:
+    if s is None or (s.from_ is None and s.to is None):
         return ""
-    frm = s.get("from")
-    to = s.get("to")
-    cur = s.get("currency") or ""
-    gross = s.get("gross")
+    return _format_salary(s.from_, s.to, s.currency or "", bool(s.gross))
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _format_salary(frm: Optional[float], to: Optional[float], cur: str, gross: bool) -> str:
+    # одинаковые вилки часто повторяются в выдаче — кэшируем готовую строку
     tax = "gross" if gross else "net"
 
-    if frm is None and to is None:
-        return ""
     if frm is None:
         return f"до {to} {cur} ({tax})"
     if to is None:
@@ -29,114 +143,212 @@ def format_salary(s: Optional[Dict[str, Any]]) -> str:
     return f"{frm}–{to} {cur} ({tax})"
 
 
-def hh_get(url: str, params: Optional[Dict[str, Any]] = None, retries: int = 5) -> Dict[str, Any]:
+class ServiceOverloadError(requests.HTTPError):
+    """hh.ru так и не ответил после ретраев из-за 429/5xx — пора сбавить темп."""
+
+
+def hh_request(url: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
     """
-    GET к API hh.ru с обработкой лимитов (429) и ретраями.
+    GET к API hh.ru. Ретраи на 429/5xx с экспоненциальным backoff
+    и учётом Retry-After делает адаптер SESSION. Ответ может прийти из кэша.
     """
-    headers = {"User-Agent": "hh-vacancy-parser (learning project)"}
+    try:
+        r = SESSION.get(url, params=params, timeout=25)
+    except requests.exceptions.RetryError as e:
+        raise ServiceOverloadError(str(e)) from e
+
+    r.raise_for_status()
+    return r
 
-    last_err: Optional[Exception] = None
-    for attempt in range(retries):
-        try:
-            r = requests.get(url, params=params, headers=headers, timeout=25)
 
-            # Rate limit
-            if r.status_code == 429:
-                wait = 1.5 * (attempt + 1)
-                time.sleep(wait)
-                continue
+class _Sample:
+    """Замер одного запроса для AdaptiveLimiter."""
 
-            r.raise_for_status()
-            return r.json()
+    __slots__ = ("response", "overloaded")
 
-        except requests.RequestException as e:
-            last_err = e
-            # небольшой backoff на сетевые/5xx
-            time.sleep(0.8 * (attempt + 1))
+    def __init__(self) -> None:
+        self.response: Optional[requests.Response] = None
+        # хотя бы одна попытка упёрлась в 429/5xx, даже если ретрай потом удался
+        self.overloaded = False
 
-    raise requests.HTTPError(f"Request failed after {retries} retries: {last_err}") from last_err
+    @property
+    def from_cache(self) -> bool:
+        # ответ из кэша ничего не говорит о задержке hh.ru
+        return getattr(self.response, "from_cache", False)
 
+    def retried_on_overload(self) -> bool:
+        """Ретраи адаптера видны в r.raw.retries.history (у ответа из кэша их нет)."""
+        retries = getattr(getattr(self.response, "raw", None), "retries", None)
+        history = getattr(retries, "history", None) or ()
+        return any(h.status in OVERLOAD_STATUSES for h in history)
 
-def collect_vacancies(
+
+class AdaptiveLimiter:
+    """
+    Адаптивный лимит параллельных запросов в духе TCP Vegas:
+    пока задержка близка к минимальной — лимит растёт, как только запросы
+    начинают копиться в очереди у сервера — уменьшается, а при первом же
+    признаке перегрузки (429/5xx на любой попытке) сразу режется вдвое.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        initial: int = 2,
+        alpha: float = 1.0,
+        beta: float = 3.0,
+        window: int = 8,
+    ) -> None:
+        self.max_limit = max_limit
+        self.limit = min(initial, max_limit)
+        self.alpha = alpha
+        self.beta = beta
+        self._rtts: Deque[float] = deque(maxlen=window)
+        self._min_rtt = float("inf")
+        self._last_cut = float("-inf")
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._inflight >= self.limit:
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(
+        self,
+        rtt: Optional[float],
+        overloaded: bool = False,
+        started: Optional[float] = None,
+    ) -> None:
+        """
+        Освобождаем слот и подстраиваем лимит. rtt=None — замера нет.
+        started — time.monotonic() начала запроса: перегрузку от запросов,
+        начатых до последнего сокращения, уже учли — режем раз на «окно».
+        """
+        with self._cond:
+            self._inflight -= 1
+
+            if overloaded:
+                if started is None or started >= self._last_cut:
+                    self.limit = max(1, self.limit // 2)
+                    self._last_cut = time.monotonic()
+            elif rtt is not None:
+                self._rtts.append(rtt)
+                self._min_rtt = min(self._min_rtt, rtt)
+                avg_rtt = sum(self._rtts) / len(self._rtts)
+
+                # сколько запросов, по оценке Vegas, "стоит в очереди" у сервера
+                queued = self.limit * (1 - self._min_rtt / avg_rtt) if avg_rtt > 0 else 0.0
+                if queued < self.alpha:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                elif queued > self.beta:
+                    self.limit = max(1, self.limit - 1)
+
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[_Sample]:
+        """Занимаем слот на время запроса и замеряем его задержку."""
+        self.acquire()
+        started = time.monotonic()
+        sample = _Sample()
+        try:
+            yield sample
+        except ServiceOverloadError:
+            sample.overloaded = True
+            raise
+        finally:
+            rtt = None if sample.from_cache else time.monotonic() - started
+            self.release(rtt, sample.overloaded or sample.retried_on_overload(), started)
+
+
+def iter_vacancies(
     text: str,
     area: Optional[str],
     pages: int,
     per_page: int,
     delay: float,
-) -> List[Dict[str, Any]]:
-    """Собираем вакансии из поиска (items)."""
-    items: List[Dict[str, Any]] = []
+) -> Iterator[Vacancy]:
+    """
+    Отдаём вакансии из поиска (items) по мере загрузки страниц,
+    чтобы детали можно было качать, не дожидаясь конца пагинации.
+    Выдача hh.ru «плывёт» между запросами, и вакансия может повториться
+    на соседней странице — такие дубли по id пропускаем.
+    """
+    seen: Set[str] = set()
 
     for page in range(pages):
         params: Dict[str, Any] = {"text": text, "page": page, "per_page": per_page}
         if area:
             params["area"] = area
 
-        data = hh_get(API_VACANCIES, params=params)
-        items.extend(data.get("items", []))
+        data = _SEARCH_DECODER.decode(hh_request(API_VACANCIES, params=params).content)
+        for v in data.items:
+            if v.id:
+                if v.id in seen:
+                    continue
+                seen.add(v.id)
+            yield v
 
-        total_pages = data.get("pages")
-        if isinstance(total_pages, int) and page + 1 >= total_pages:
+        if data.pages is not None and page + 1 >= data.pages:
             break
 
         time.sleep(delay)
 
-    return items
 
+def _details_fields(d: VacancyDetails) -> Tuple[str, str, str, str, str]:
+    """experience / schedule / employment / key_skills / description_snippet."""
+    skills = ", ".join(ks.name for ks in (d.key_skills or []) if ks.name)
 
-def enrich_with_details(items: List[Dict[str, Any]], delay: float) -> List[Dict[str, Any]]:
-    """
-    Дотягиваем детали по каждой вакансии из detail endpoint:
-    опыт / график / занятость / ключевые навыки / description snippet.
-    """
-    enriched: List[Dict[str, Any]] = []
+    # HH возвращает HTML. Снимаем теги и делаем аккуратный короткий snippet.
+    # Для 300 символов текста хватает начала описания — весь HTML не разбираем.
+    text = LexborHTMLParser((d.description or "")[:2000]).text(separator=" ")
+    desc = _WS_RE.sub(" ", text).strip()  # убираем лишние пробелы/переносы
 
-    for v in items:
-        url = v.get("url")
-        if not url:
-            enriched.append(v)
-            continue
-
-        try:
-            d = hh_get(url)
-
-            v["experience_name"] = (d.get("experience") or {}).get("name", "")
-            v["schedule_name"] = (d.get("schedule") or {}).get("name", "")
-            v["employment_name"] = (d.get("employment") or {}).get("name", "")
+    return (
+        _name(d.experience),
+        _name(d.schedule),
+        _name(d.employment),
+        skills,
+        desc[:300],
+    )
 
-            skills = [ks.get("name", "") for ks in (d.get("key_skills") or []) if ks.get("name")]
-            v["key_skills"] = ", ".join(skills)
 
-            # HH возвращает HTML. Делаем аккуратный короткий snippet.
-            desc = d.get("description") or ""
-            desc = " ".join(desc.split())  # убираем лишние пробелы/переносы
-            v["description_snippet"] = desc[:300]
+def _fetch_details(v: Vacancy, limiter: AdaptiveLimiter) -> Vacancy:
+    """Детали одной вакансии: опыт / график / занятость / навыки / snippet."""
+    if not v.url:
+        return v
 
-        except requests.RequestException:
-            v["experience_name"] = ""
-            v["schedule_name"] = ""
-            v["employment_name"] = ""
-            v["key_skills"] = ""
-            v["description_snippet"] = ""
+    try:
+        with limiter.slot() as sample:
+            r = hh_request(v.url)
+            sample.response = r
+        d = _DETAILS_DECODER.decode(r.content)
+    except (requests.RequestException, msgspec.DecodeError):
+        # детали останутся пустыми
+        return v
 
-        enriched.append(v)
-        time.sleep(delay)
+    (
+        v.experience_name,
+        v.schedule_name,
+        v.employment_name,
+        v.key_skills,
+        v.description_snippet,
+    ) = _details_fields(d)
 
-    return enriched
+    return v
 
 
-def save_csv(
-    items: List[Dict[str, Any]],
-    path: str,
-    include_details: bool,
-    query_text: str,
-    area_id: Optional[str],
-    collected_at: str,
-) -> None:
+class CsvSink:
     """
-    Сохраняем в CSV (utf-8-sig) + добавляем метаданные (запрос/регион/время сборки).
+    CSV (utf-8-sig) + метаданные (запрос/регион/время сборки).
+    Строки пишутся сразу, как только вакансия готова, — без накопления в памяти.
+    Пишем в соседний path + ".part" и подменяем им path только при успешном
+    завершении: упавший запуск не затирает прошлую выгрузку.
     """
-    base_fields = [
+
+    BASE_FIELDS = [
         "name",
         "employer",
         "salary",
@@ -148,7 +360,7 @@ def save_csv(
         "collected_at",
     ]
 
-    details_fields = [
+    DETAILS_FIELDS = [
         "experience_name",
         "schedule_name",
         "employment_name",
@@ -156,37 +368,108 @@ def save_csv(
         "description_snippet",
     ]
 
-    fields = base_fields + (details_fields if include_details else [])
-
-    with open(path, "w", newline="", encoding="utf-8-sig") as f:
-        w = csv.DictWriter(f, fieldnames=fields)
-        w.writeheader()
-
-        for v in items:
-            row = {
-                "name": v.get("name", ""),
-                "employer": (v.get("employer") or {}).get("name", ""),
-                "salary": format_salary(v.get("salary")),
-                "area": (v.get("area") or {}).get("name", ""),
-                "published_at": v.get("published_at", ""),
-                "hh_url": v.get("alternate_url", ""),
-                "query_text": query_text,
-                "area_id": area_id or "",
-                "collected_at": collected_at,
-            }
-
-            if include_details:
-                row.update(
-                    {
-                        "experience_name": v.get("experience_name", ""),
-                        "schedule_name": v.get("schedule_name", ""),
-                        "employment_name": v.get("employment_name", ""),
-                        "key_skills": v.get("key_skills", ""),
-                        "description_snippet": v.get("description_snippet", ""),
-                    }
-                )
-
-            w.writerow(row)
+    # крупный буфер + явный flush раз в FLUSH_EVERY строк: меньше write(2),
+    # но .part-файл всё равно растёт по ходу сбора
+    BUFFER_SIZE = 1 << 20
+    FLUSH_EVERY = 500
+
+    def __init__(
+        self,
+        path: str,
+        include_details: bool,
+        query_text: str,
+        area_id: Optional[str],
+        collected_at: str,
+    ) -> None:
+        self.path = path
+        self.include_details = include_details
+        self.count = 0
+        self._tmp_path = path + ".part"
+
+        # query_text / area_id / collected_at одинаковы для всех строк
+        self._meta = (query_text, area_id or "", collected_at)
+
+        fields = self.BASE_FIELDS + (self.DETAILS_FIELDS if include_details else [])
+
+        self._f = open(self._tmp_path, "w", newline="", encoding="utf-8-sig", buffering=self.BUFFER_SIZE)
+        # bound method: без поиска атрибута writer.writerow на каждую строку
+        self._writerow = csv.writer(self._f).writerow
+        self._writerow(fields)
+
+    def write(self, v: Vacancy) -> None:
+        # порядок значений = BASE_FIELDS (+ DETAILS_FIELDS)
+        row = (
+            v.name or "",
+            _name(v.employer),
+            format_salary(v.salary),
+            _name(v.area),
+            v.published_at or "",
+            v.alternate_url or "",
+            *self._meta,
+        )
+
+        if self.include_details:
+            row += (
+                v.experience_name,
+                v.schedule_name,
+                v.employment_name,
+                v.key_skills,
+                v.description_snippet,
+            )
+
+        self._writerow(row)
+        self.count += 1
+        if self.count % self.FLUSH_EVERY == 0:
+            self._f.flush()
+
+    def close(self) -> None:
+        """Дописываем файл и атомарно подменяем им path."""
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self) -> None:
+        """Сбор не удался: path не трогаем, недописанный файл удаляем."""
+        self._f.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self) -> "CsvSink":
+        return self
+
+    def __exit__(self, exc_type: Any, *exc: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def enrich_with_details(items: Iterable[Vacancy], workers: int, sink: CsvSink) -> None:
+    """
+    Дотягиваем детали по каждой вакансии из detail endpoint и пишем в sink.
+    Запросы идут параллельно через общую SESSION: до workers штук,
+    фактическую параллельность подбирает AdaptiveLimiter.
+    Если items — генератор страниц поиска, детали начинают качаться
+    сразу по приходу первой страницы. Порядок вакансий сохраняется:
+    строка пишется, как только готовы она и все предыдущие.
+    """
+    limiter = AdaptiveLimiter(max_limit=workers)
+    pending: Deque["Future[Vacancy]"] = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        try:
+            for v in items:
+                pending.append(ex.submit(_fetch_details, v, limiter))
+                while pending and pending[0].done():
+                    sink.write(pending.popleft().result())
+
+            while pending:
+                sink.write(pending.popleft().result())
+        except BaseException:
+            # Страница поиска упала или Ctrl-C: CsvSink всё равно выбросит
+            # недописанный файл, так что ещё не начатые запросы снимаем,
+            # а не ждём их на выходе из пула.
+            for f in pending:
+                f.cancel()
+            raise
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -195,9 +478,10 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--area", default="", help="Area id, например 1=Москва, 2=СПб. Пусто = без фильтра")
     p.add_argument("--pages", type=int, default=2, help="Сколько страниц взять (по 0..pages-1)")
     p.add_argument("--per-page", type=int, default=50, help="Вакансий на страницу (1..100)")
-    p.add_argument("--delay", type=float, default=0.3, help="Пауза между запросами (сек)")
+    p.add_argument("--delay", type=float, default=0.3, help="Пауза между страницами поиска (сек)")
     p.add_argument("--out", default="vacancies.csv", help="Имя CSV файла")
     p.add_argument("--details", action="store_true", help="Дозагружать детали по каждой вакансии (медленнее)")
+    p.add_argument("--workers", type=int, default=8, help=f"Максимум параллельных запросов деталей (1..{MAX_WORKERS})")
     p.add_argument("--timestamp", action="store_true", help="Добавить timestamp к имени файла")
     return p
 
@@ -212,15 +496,11 @@ def main() -> None:
     per_page = max(1, min(100, args.per_page))
     pages = max(1, args.pages)
     delay = max(0.0, args.delay)
+    workers = max(1, min(MAX_WORKERS, args.workers))
     area_id = args.area.strip() or None
 
     collected_at = datetime.now().isoformat(timespec="seconds")
 
-    items = collect_vacancies(query_text, area_id, pages, per_page, delay)
-
-    if args.details and items:
-        items = enrich_with_details(items, delay=max(0.2, delay))
-
     out = args.out
     if args.timestamp:
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -229,17 +509,23 @@ def main() -> None:
         else:
             out = out + f"_{ts}.csv"
 
-    save_csv(
-        items=items,
+    found = iter_vacancies(query_text, area_id, pages, per_page, delay)
+
+    with CsvSink(
         path=out,
         include_details=args.details,
         query_text=query_text,
         area_id=area_id,
         collected_at=collected_at,
-    )
+    ) as sink:
+        if args.details:
+            enrich_with_details(found, workers=workers, sink=sink)
+        else:
+            for v in found:
+                sink.write(v)
 
     print(f"OK: {out}")
-    print(f"Vacancies: {len(items)}")
+    print(f"Vacancies: {sink.count}")
     if args.details:
         print("Details: enabled (extra requests per vacancy)")
     if area_id: